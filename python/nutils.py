@@ -17,6 +17,8 @@ def read_conf(path, result = {}):
 
 def read_conf_text(text, result = {}, regexp='^([A-Za-z][\w]*)=([^#]*)(#.*)?'):
     """Read plain-text configuration file consisting of <key>=<value> pairs.
+
+    text -- iterable of lines, for example a list or a file object
     """
 
     if (not text):
@@ -0,0 +1,292 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+"""Pool of persistent shell processes for running product generator scripts.
+
+Starting a generator script normally costs a fork and exec of a new bash
+interpreter. A worker in this pool is a long-lived bash process which
+only forks a subshell per job and sources the script in it.
+
+The pool is applied to bash scripts only, with a plain interpreter line
+(see BASH_INTERPRETER_LINES); options like ``#!/bin/bash -e`` would be lost
+when sourcing, so such scripts are started as separate processes.
+Sourced scripts see the shell, not the script, as ``$0``; scripts depending
+on that should not be run through the pool.
+"""
+
+__version__ = '0.1'
+__author__ = 'Markus.Peura@fmi.fi'
+
+import os
+import queue
+import tempfile
+import functools
+import subprocess
+
+import logging
+
+
+# Runs a job in a subshell, sourcing the script with a cleared environment.
+RUN_FUNCTION = r'''
+__run() {
+    (
+        for __kv in $(compgen -e); do unset "$__kv" 2> /dev/null; done
+        cd "$1" || exit 127
+        export PWD
+        __script=$2
+        shift 2
+        for __kv; do export "$__kv"; done
+        set --
+        unset -v __dir __out __err __n __i __env __kv __max __pids __running __pid
+        . "$__script"
+    ) < /dev/null
+}
+'''
+
+# Reads the next job record: dir, script, outfile, errfile, number of
+# environment entries, followed by the KEY=VALUE entries, each NUL-terminated.
+# An empty errfile means inherited stderr, '&1' means stderr merged to outfile.
+READ_RECORD = r'''
+    IFS= read -r -d '' __script
+    IFS= read -r -d '' __out
+    IFS= read -r -d '' __err
+    IFS= read -r -d '' __n
+    __env=()
+    for (( __i=0; __i<__n; __i++ )); do
+        IFS= read -r -d '' __kv
+        __env+=("$__kv")
+    done
+'''
+
+# Worker loop, executing one job at a time.
+# After each job, the exit code of the script is written to stdout.
+WORKER_SCRIPT = RUN_FUNCTION + r'''
+while IFS= read -r -d '' __dir; do
+''' + READ_RECORD + r'''
+    case "$__err" in
+        '')   __run "$__dir" "$__script" "${__env[@]}" > "$__out" ;;
+        '&1') __run "$__dir" "$__script" "${__env[@]}" > "$__out" 2>&1 ;;
+        *)    __run "$__dir" "$__script" "${__env[@]}" > "$__out" 2> "$__err" ;;
+    esac
+    echo $?
+done
+'''
+
+# Batch of jobs, running at most $1 jobs at a time. Once stdin is exhausted,
+# the exit codes of the jobs are written to stdout in the order of the records.
+BATCH_SCRIPT = RUN_FUNCTION + r'''
+__max=$1
+__pids=()
+__running=0
+while IFS= read -r -d '' __dir; do
+''' + READ_RECORD + r'''
+    if (( __running >= __max )); then
+        wait -n
+        (( __running-- ))
+    fi
+    case "$__err" in
+        '')   __run "$__dir" "$__script" "${__env[@]}" > "$__out" & ;;
+        '&1') __run "$__dir" "$__script" "${__env[@]}" > "$__out" 2>&1 & ;;
+        *)    __run "$__dir" "$__script" "${__env[@]}" > "$__out" 2> "$__err" & ;;
+    esac
+    __pids+=($!)
+    (( __running++ ))
+done
+for __pid in "${__pids[@]}"; do
+    wait "$__pid"
+    echo $?
+done
+'''
+
+
+# Interpreter lines of scripts that can be sourced without changing their behaviour
+BASH_INTERPRETER_LINES = (b'#!/bin/bash', b'#!/usr/bin/env bash')
+
+@functools.lru_cache(maxsize=1024)
+def _cached_is_bash_script(path, mtime):
+    """Read the interpreter line once per path and modification time, see is_bash_script()."""
+    try:
+        with open(path, 'rb') as f:
+            line = f.readline(256)
+    except OSError:
+        return False
+    return line.rstrip() in BASH_INTERPRETER_LINES
+
+def is_bash_script(path):
+    """Check if the interpreter line of a script is plain bash, without options.
+
+    The result is cached until the script is modified.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+    return _cached_is_bash_script(path, mtime)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _encode_record(script, outfile, errfile, env):
+    """Job record for WORKER_SCRIPT."""
+    record = [str(script.parent), str(script), outfile, errfile, str(len(env))]
+    record.extend('{0}={1}'.format(k, v) for k,v in env.items())
+    return b''.join(x.encode('UTF-8') + b'\0' for x in record)
+
+
+def run_batch(jobs, max_parallel=1):
+    """Run several bash scripts in a single shell process.
+
+    jobs -- list of (script, env) pairs
+    max_parallel -- maximum number of scripts running simultaneously
+    Returns a list of (returncode, output) pairs, stderr merged to output.
+    """
+    outfiles = []
+    try:
+        data = []
+        for script,env in jobs:
+            fd,outfile = tempfile.mkstemp(prefix='nutshell-', suffix='.out')
+            os.close(fd)
+            outfiles.append(outfile)
+            data.append(_encode_record(script, outfile, '&1', env))
+        p = subprocess.Popen(['bash', '-c', BATCH_SCRIPT, 'bash', str(max(1, max_parallel))],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             env={})
+        codes,_ = p.communicate(b''.join(data))
+        codes = codes.split()
+        results = []
+        for i,outfile in enumerate(outfiles):
+            # Missing code: the shell process terminated prematurely
+            returncode = int(codes[i]) if (i < len(codes)) else -1
+            results.append((returncode, _read_bytes(outfile)))
+        return results
+    finally:
+        for f in outfiles:
+            try:
+                os.unlink(f)
+            except OSError:
+                pass
+
+
+class PooledProcess:
+    """Job executed by a ShellPool worker.
+
+    Mimics the part of subprocess.Popen used by ProductServer: communicate() and returncode.
+    """
+
+    returncode = None
+
+    def __init__(self, pool, script, stderr, env):
+        self.pool = pool
+        self.script = script
+        self.stderr = stderr
+        self.env = env
+
+    def _fallback(self):
+        """Run the script as a standalone process, used if the job could not be passed to a worker."""
+        try:
+            p = subprocess.Popen([str(self.script)],
+                                 cwd=str(self.script.parent),
+                                 stdout=subprocess.PIPE,
+                                 stderr=self.stderr,
+                                 env=self.env)
+        except OSError as e:
+            self.pool.log.error('Could not execute {0}: {1}'.format(self.script, e))
+            self.returncode = -1
+            return (None, None)
+        stdout,stderr = p.communicate()
+        self.returncode = p.returncode
+        return (stdout, stderr)
+
+    def communicate(self):
+        """Run the job on a free worker and return (stdout, stderr) as bytes."""
+
+        fd,outfile = tempfile.mkstemp(prefix='nutshell-', suffix='.out')
+        os.close(fd)
+        errfile = ''
+        if (self.stderr == subprocess.STDOUT):
+            errfile = '&1'
+        elif (self.stderr == subprocess.PIPE):
+            fd,errfile = tempfile.mkstemp(prefix='nutshell-', suffix='.err')
+            os.close(fd)
+
+        try:
+            code = self.pool.run(_encode_record(self.script, outfile, errfile, self.env))
+            if (code == None):
+                return self._fallback()
+            self.returncode = code
+            stdout = _read_bytes(outfile)
+            stderr = None
+            if (self.stderr == subprocess.PIPE):
+                stderr = _read_bytes(errfile)
+            return (stdout, stderr)
+        finally:
+            for f in (outfile, errfile):
+                if (f and f != '&1'):
+                    try:
+                        os.unlink(f)
+                    except OSError:
+                        pass
+
+
+class ShellPool:
+    """Fixed-size set of persistent bash workers, shared by threads."""
+
+    def __init__(self, size, log=None):
+        self.log = log or logging.getLogger("ShellPool")
+        self.size = size
+        self.workers = queue.Queue()
+        for i in range(size):
+            self.workers.put(self._spawn())
+
+    def _spawn(self):
+        # Empty environment, as for scripts started by ProductServer
+        return subprocess.Popen(['bash', '-c', WORKER_SCRIPT],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                env={})
+
+    def start(self, script, stderr, env):
+        """Return a job for script, or None if the script is not applicable in the pool."""
+        if (not is_bash_script(str(script))):
+            return None
+        return PooledProcess(self, script, stderr, env)
+
+    def run(self, data):
+        """Execute an encoded job record on a free worker.
+
+        Returns the exit code; -1 if the worker failed during the job,
+        or None if the job could not be passed to a worker (so it was not started).
+        """
+        worker = self.workers.get()
+        try:
+            try:
+                worker.stdin.write(data)
+                worker.stdin.flush()
+            except OSError as e:
+                self.log.warning('Shell worker not available ({0}), restarting it'.format(e))
+                worker = self._restart(worker)
+                return None
+            try:
+                return int(worker.stdout.readline())
+            except (OSError, ValueError) as e:
+                # The job may have been partly executed: do not run it again
+                self.log.warning('Shell worker failed during job ({0}), restarting it'.format(e))
+                worker = self._restart(worker)
+                return -1
+        finally:
+            self.workers.put(worker)
+
+    def _restart(self, worker):
+        worker.kill()
+        worker.wait()
+        return self._spawn()
+
+    def close(self):
+        """Terminate the workers."""
+        while not self.workers.empty():
+            worker = self.workers.get()
+            worker.stdin.close()
+            worker.wait()
@@ -14,10 +14,15 @@ import argparse
 import nutshell.nutils
 
 
+# Compiled once; timestamps are pruned on every product parse
+_NONWORD_RE = re.compile(r"\W")
 
-def parse_timestamp(timestamp, result = {}):
+
+def parse_timestamp(timestamp, result = None):
+    if (result == None):
+        result = {}
     if (timestamp):
-        t = re.sub("\W", "", timestamp)
+        t = _NONWORD_RE.sub("", timestamp)
         result['TIMESTAMP'] = t[0:12] # empty ok?
         result['YEAR']      = t[0:4]
         result['MONTH']     = t[4:6]
@@ -147,7 +152,7 @@ class ProductInfo:
         Todo: support for time object, unix seconds and date string parsing.
         """
         
-        self.TIMESTAMP = re.sub("\W", "", timestamp)
+        self.TIMESTAMP = _NONWORD_RE.sub("", timestamp)
 
     def set_format(self, extension):
         """Sets file format (png, txt, pgm.gz, txt.zip, ...)."""
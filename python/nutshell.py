@@ -71,12 +71,17 @@ References:
 __version__ = '0.1'
 __author__ = 'Markus.Peura@fmi.fi'
 
+import io
 import os
 import re
+import time
+import functools
+import threading
 import subprocess # for shell escape
 
 from pathlib import Path
 from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
 #import http.server
 #HTTPresponses = http.server.SimpleHTTPRequestHandler.responses
 
@@ -88,13 +93,19 @@ logging.basicConfig(format='%(levelname)s\t %(name)s: %(message)s')
 
 from . import nutils
 from . import nutproduct
+from . import nutpool
 
 
+# Default loggers of requests, resolved once
+_INPUT_INFO_LOGGER = logging.getLogger("InputInfo." + __name__)
+_PRODUCT_REQUEST_LOGGER = logging.getLogger("ProductRequest")
 
 
-def parse_timestamp2(timestamp, result = {}):
+def parse_timestamp2(timestamp, result = None):
+    if (result == None):
+        result = {}
     if (timestamp):
-        t = re.sub("\W", "", timestamp)
+        t = nutproduct._NONWORD_RE.sub("", timestamp)
         result['TIMESTAMP'] = t[0:12] # empty ok?
         result['YEAR']      = t[0:4]
         result['MONTH']     = t[4:6]
@@ -106,6 +117,44 @@ def parse_timestamp2(timestamp, result = {}):
 
 
 
+@functools.lru_cache(maxsize=4096)
+def _compute_time_dir(timestamp, syntax):
+    """Format time directory, memoized as the same timestamps recur in input requests."""
+    timevars = nutproduct.parse_timestamp(timestamp)
+    return syntax.format(**timevars) # + os.sep
+
+
+@functools.lru_cache(maxsize=8192)
+def _parse_product_info(filename):
+    """Parse a product filename, memoized as the same inputs recur in sibling requests.
+
+    The returned ProductInfo is shared by all the callers: it must not be modified.
+    """
+    return nutproduct.ProductInfo(filename)
+
+
+def touch(path):
+    """Create an empty file, if non-existent, without a Python file object."""
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666))
+
+
+# HTTP status code leading the last output line of a failed script
+_STATUS_RE = re.compile(r"^\s*(\d+)")
+
+
+# Seconds a cached generator script existence check remains valid
+_EXISTS_TTL = 10
+
+@functools.lru_cache(maxsize=1024)
+def _cached_exists(path, epoch):
+    """Check file existence once per path and TTL epoch, see path_exists()."""
+    return os.path.exists(path)
+
+def path_exists(path):
+    """Existence check for static resources (generator scripts), cached for _EXISTS_TTL seconds."""
+    return _cached_exists(str(path), int(time.monotonic() // _EXISTS_TTL))
+
+
 ProductInfo = nutproduct.ProductInfo
 
 
@@ -119,6 +168,21 @@ class ProductServer:
     SHELL_GENERATOR_SCRIPT = 'generate.sh'
     SHELL_INPUT_SCRIPT = 'input.sh'
 
+    # Maximum number of input products generated in parallel, per request
+    MAX_INPUT_WORKERS = 8
+
+    # Number of persistent bash workers running the scripts, 0 = start each script as a new process
+    SHELL_POOL_SIZE = 0
+
+    # Seconds a missing generator is remembered, requests for the product fail fast meanwhile
+    NO_GENERATOR_TTL = 60
+
+    # Seconds a script may wait for a free process slot before the request is rejected
+    PROCESS_QUEUE_TIMEOUT = 300
+
+    # Limits the number of generator and input scripts running simultaneously, process-wide
+    _gen_sem = threading.BoundedSemaphore(int(os.environ.get('NUTSHELL_MAX_CONCURRENCY', 8)))
+
     # HTTP Server Options (forward defs HTTP server, so perhaps later moved to NutServer )
     HTTP_PORT = 8088
     HTTP_NAME = ''
@@ -151,7 +215,7 @@ class ProductServer:
         parser.add_argument("-r", "--request", metavar="<string>",
                             dest="REQUEST",
                             default="",
-                            help="comma-separated string of [DELETE|MAKE|INPUTS]")
+                            help="comma-separated string of [DELETE|MAKE|MAKE_BATCH|INPUTS]")
     
         parser.add_argument("-d", "--delete",
                             dest="DELETE",
@@ -207,21 +271,24 @@ class ProductServer:
         # Later, use (dir + file) object
         inputs = {}
         
-        actions = []
-        directives = []
+        actions = frozenset()
+        directives = frozenset()
         
         # Nutshell native log output
         log = None
         
-        # Std output of the generation
+        # Std output of the generation (bytes)
         stdout = None
         
-        # Error output of the generation
+        # Error output of the generation (bytes)
         stderr = None
         
         # Return code of the generation
         returncode = 0
 
+        # Last line of output of a failed generation
+        error_info = ''
+
         # Status, defined using HTTP status codes
         status = HTTPStatus.OK
 
@@ -244,32 +311,33 @@ class ProductServer:
             self.product_server = product_server
 
             if (type(product_info) == str):
-                self.product_info = ProductInfo(product_info)
-            else:        
-                self.product_info = product_info
+                product_info = _parse_product_info(product_info)
+            self.product_info = product_info
 
             if log:
                 self.log = log
             else:
-                self.log = logging.getLogger("ProductRequest")
+                self.log = _PRODUCT_REQUEST_LOGGER
  
-            if (actions):
-                self.actions = actions
-            else:
-                self.actions = []
+            # Stored as sets for constant-time membership checks
+            if (type(actions) == str):
+                actions = actions.split(',')
+            self.actions = frozenset(actions or [])
             self.log.debug('actions:' + str(actions))
   
-            if (directives):              
-                self.directives = directives
-            else:
-                self.directives = []
-            self.log.debug('directives: ' + str(self.directives))
+            if (type(directives) == str):
+                directives = directives.split(',')
+            self.directives = frozenset(directives or [])
+            self.log.debug('directives: ' + str(directives))
 
             self.generator_path = Path(product_server.get_generator_dir(product_info), 
                                        product_server.SHELL_GENERATOR_SCRIPT)
             
             self.product = None
             self.inputs = {}
+
+            # Product parameters as environment variables for the scripts (read-only, copy to modify)
+            self._env = self.product_info.get_param_env()
             #self.log = nutils.Log()
            
             filename        = product_info.filename()
@@ -277,18 +345,23 @@ class ProductServer:
             #cache_dir_dyn = product_server.get_dynamic_cache_dir(product_info)
             #cache_dir = product_server.get_cache_dir(product_info)
             #cache_root = product_server.CACHE_ROOT
-            cache_root = Path(product_server.CACHE_ROOT)
-            cache_root = str(cache_root.absolute())
+            cache_root = os.path.abspath(product_server.CACHE_ROOT)
             time_dir = product_server.get_time_dir(product_info)
             prod_dir = product_server.get_product_dir(product_info)
       
-      
+            # Paths are assembled as strings, and parsed to Path objects only once
+            rel_dir = os.path.join(time_dir, prod_dir)
+            dyn_dir = os.path.join(cache_root, rel_dir)
+            static_dir = os.path.join(cache_root, prod_dir)
+            self._path_str     = os.path.join(dyn_dir, filename)
+            self._path_tmp_str = os.path.join(dyn_dir, 'tmp', filename)
+
             # Target path. Will be cleared (to None) if product generation fails.
-            self.path_relative = Path(time_dir, prod_dir, filename)
-            self.path =        Path(cache_root, time_dir, prod_dir, filename)
-            self.path_tmp =    Path(cache_root, time_dir, prod_dir, 'tmp', filename)  
-            self.path_static = Path(cache_root, prod_dir, filename)
-            self.path_latest = Path(cache_root, prod_dir, filename_latest)
+            self.path_relative = Path(os.path.join(rel_dir, filename))
+            self.path =        Path(self._path_str)
+            self.path_tmp =    Path(self._path_tmp_str)
+            self.path_static = Path(os.path.join(static_dir, filename))
+            self.path_latest = Path(os.path.join(static_dir, filename_latest))
             
             self.set_status( HTTPStatus.NO_CONTENT)  #204 # No content
             self.returncode = -1
@@ -309,6 +382,10 @@ class ProductServer:
         log = None
         
         returncode = 0
+
+        error_info = ''
+
+        status = HTTPStatus.OK
         #def __init__(self, product_info):
         #    self.gdir = self.get_generator_dir(product_info)
         #    self.inputs = {}
@@ -323,7 +400,7 @@ class ProductServer:
          if (log):
              info.log = log
          else:
-             info.log = logging.getLogger("InputInfo"+__name__)  #nutils.Log()
+             info.log = _INPUT_INFO_LOGGER  #nutils.Log()
         
          info.returncode = 0
                 
@@ -333,17 +410,22 @@ class ProductServer:
     def init_path(self, dirname, check_existence=False):
         """ Expand relative path to absolute, optionally check that exists. """ 
         #if (hasattr(self, dirname)):
-        path = Path(getattr(self, dirname)).absolute()
+        path = os.path.abspath(getattr(self, dirname))
         self.logger.warn('  {0} =>  {1}'.format(dirname, path))
-        if (check_existence) and not (path.exists()):
-            raise FileNotFoundError(__name__ + str(path))
-        setattr(self, dirname, str(path)) # TODO -> Path obj
+        if (check_existence) and not (os.path.exists(path)):
+            raise FileNotFoundError(__name__ + path)
+        setattr(self, dirname, path) # TODO -> Path obj
         #else:
         #     raise KeyError   
             
         
     def __init__(self, conffile = ''): 
         self.logger = logging.getLogger("NutShell2")
+        self._gendir_cache = {}
+        self._mkdir_cache = set()
+        self._no_generator = {}
+        self._shell_pool = None
+        self._shell_pool_lock = threading.Lock()
         if (conffile):
             self.read_conf(conffile)
         if __name__ == '__main__':
@@ -381,33 +463,87 @@ class ProductServer:
             if (timestamp == 'LATEST'):
                 return ''
             else:
-                timevars = nutproduct.parse_timestamp(timestamp)
-                # print timevars
-                return self.TIME_DIR_SYNTAX.format(**timevars) # + os.sep
+                return _compute_time_dir(timestamp, self.TIME_DIR_SYNTAX)
         else:
             return ''
 
     
     
     def get_generator_dir(self, product_info):
-        path = Path(self.PRODUCT_ROOT, *product_info.ID.split('.'))
-        return str(path.absolute())
+        key = (self.PRODUCT_ROOT, product_info.ID)
+        if (key in self._gendir_cache):
+            return self._gendir_cache[key]
+        path = os.path.abspath(os.path.join(self.PRODUCT_ROOT, *product_info.ID.split('.')))
+        self._gendir_cache[key] = path
+        return path
         #return self.PRODUCT_ROOT+os.sep+product_info.ID.replace('.', os.sep)
 
    
 
     # Generalize?
-    def ensure_output_dir(self, outdir):
+    def ensure_output_dir(self, outdir, verify=False):
         """Creates a writable directory, if non-existent
+
+        Directories created or found earlier are remembered and not checked again,
+        unless verify is set: then a remembered directory is checked with a single stat,
+        for directories that may be removed by cache cleanup.
         """
-        try:
-            original_umask = os.umask(0)
-            os.makedirs(str(outdir), 0o775, True)
-        finally:
-            os.umask(original_umask)
+        dirname = str(outdir)
+        if (dirname in self._mkdir_cache):
+            if (not verify) or (os.path.isdir(dirname)):
+                return outdir
+        # The umask is process-wide and requests run in threads: instead of
+        # clearing it, set the mode of the new directories explicitly.
+        created = []
+        d = dirname
+        while (d) and not (os.path.isdir(d)):
+            created.append(d)
+            parent = os.path.dirname(d)
+            if (parent == d):
+                break
+            d = parent
+        os.makedirs(dirname, 0o775, True)
+        for d in created:
+            try:
+                os.chmod(d, 0o775)
+            except OSError:
+                pass # created concurrently by another user
+        # The parent was created as well
+        self._mkdir_cache.add(os.path.dirname(dirname))
+        self._mkdir_cache.add(dirname)
         return outdir
 
 
+    def get_shell_pool(self):
+        """Returns the pool of persistent shell workers, started on first call."""
+        with self._shell_pool_lock:
+            if (self._shell_pool == None):
+                self.logger.info('Starting {0} shell workers'.format(self.SHELL_POOL_SIZE))
+                self._shell_pool = nutpool.ShellPool(int(self.SHELL_POOL_SIZE), self.logger.getChild('ShellPool'))
+        return self._shell_pool
+
+    def start_process(self, script, stderr, env, log):
+        """Execute a script directly, without an intermediate shell.
+
+        The script must be executable and start with an interpreter line (#!/bin/bash).
+        If SHELL_POOL_SIZE is set, bash scripts are run by persistent shell workers instead.
+        Returns None if the script could not be started.
+        """
+        if (int(self.SHELL_POOL_SIZE) > 0):
+            p = self.get_shell_pool().start(script, stderr, env)
+            if (p):
+                return p
+        try:
+            return subprocess.Popen([str(script)],
+                                    cwd=str(script.parent),
+                                    stdout=subprocess.PIPE, # always
+                                    stderr=stderr,
+                                    shell=False,
+                                    env=env)
+        except OSError as e:
+            log.error('Could not execute {0}: {1}'.format(script, e))
+            return None
+
     def run_process(self, p, task, log):
         if (not p):
             log.warn('No process') 
@@ -416,56 +552,76 @@ class ProductServer:
             return
 
         stdout,stderr = p.communicate()
-        task.returncode = p.returncode        
+        self.set_process_result(task, p.returncode, stdout, stderr, log)
 
+    def set_process_result(self, task, returncode, stdout, stderr, log):
+        """Store return code and outputs of a script in task, and derive status of a failure."""
+        task.returncode = returncode
+
+        # Outputs are kept as bytes; only the last line is decoded, for the error info
         if (stdout):
-            stdout = stdout.decode(encoding='UTF-8')
-            if (p.returncode != 0):
-                lines = stdout.strip().split('\n')
-                task.error_info = lines.pop()
+            if (returncode != 0):
+                end = len(stdout)
+                while (end > 0) and stdout[end-1:end].isspace():
+                    end -= 1
+                start = stdout.rfind(b'\n', 0, end) + 1
+                task.error_info = stdout[start:end].decode('UTF-8', 'replace').strip()
                 log.warn(task.error_info)
                 try:             
-                    status = int(task.error_info.split(' ')[0])
-                    task.status = HTTPStatus(status)
-                except ValueError:
+                    m = _STATUS_RE.match(task.error_info)
+                    task.status = HTTPStatus(int(m.group(1)))
+                except (ValueError, AttributeError):
                     log.warn('Not HTTP error code: {0} '.format(task.status))
                     task.status = HTTPStatus.CONFLICT
-        if (stderr):
-            stderr = stderr.decode(encoding='UTF-8')
         task.stdout = stdout  
         task.stderr = stderr
+
+    def run_script(self, script, stderr, env, task, log):
+        """Start a script and wait for its completion, storing the results in task.
+
+        Scripts queue for one of NUTSHELL_MAX_CONCURRENCY slots. If none is available
+        within PROCESS_QUEUE_TIMEOUT seconds, task status is set to SERVICE_UNAVAILABLE.
+        """
+        if (not self._gen_sem.acquire(timeout=float(self.PROCESS_QUEUE_TIMEOUT))):
+            log.error('No free process slot for: {0}'.format(script))
+            task.returncode = -1
+            task.status = HTTPStatus.SERVICE_UNAVAILABLE
+            return
+        try:
+            p = self.start_process(script, stderr, env, log)
+            self.run_process(p, task, log)
+        finally:
+            self._gen_sem.release()
         
                    
-    def get_input_list(self, product_info, directives, log):
+    def get_input_list(self, product_info, directives, log, env=None):
         """ Used for reading dynamic input configuration generated by input.sh.
         directives determine how the product is generated. 
+        env -- product parameters, if already derived with product_info.get_param_env()
         """
 
         input_info = self.InputInfo(product_info)
         
-        if (not input_info.script.exists()):
+        if (not path_exists(input_info.script)):
             log.debug("No input script: {0}".format(input_info.script))         
             return input_info   
         
         # TODO generalize (how)
-        env = product_info.get_param_env()
+        if (env == None):
+            env = product_info.get_param_env()
         log.debug(env)
         
-        p = subprocess.Popen(str(input_info.script),
-                             cwd=str(input_info.script.parent),
-                             stdout=subprocess.PIPE, # always
-                             stderr=self.stderr, # stdout for cmd-line and subprocess.PIPE (separate) for http usage
-                             shell=True,
-                             env=env)
-
-        self.run_process(p, input_info, log)  # log    
+        # stderr: stdout for cmd-line and subprocess.PIPE (separate) for http usage
+        self.run_script(input_info.script, self.stderr, env, input_info, log)
 
         if (input_info.returncode == 0): 
             #log.warning("inputsss")
-            nutils.read_conf_text(input_info.stdout.split('\n'), input_info.inputs)
+            # Lines are decoded one at a time, without materializing the whole text
+            lines = io.TextIOWrapper(io.BytesIO(input_info.stdout), encoding='UTF-8')
+            nutils.read_conf_text(lines, input_info.inputs)
             log.info(input_info.inputs)
         else:
-            log.warning("executing failed with error code={0}: {1} ".format(p.returncode, input_info.script))
+            log.warning("executing failed with error code={0}: {1} ".format(input_info.returncode, input_info.script))
             log.warning(input_info.error_info)
         #    else:
         #        log.critical("input script reported no error info")
@@ -490,25 +646,55 @@ class ProductServer:
         product_request.log.info('run_generator: ' + product_request.product_info.ID)
         product_request.log.debug(params)
     
-        p = subprocess.Popen(str(product_request.generator_path), #'./'+self.SHELL_GENERATOR_SCRIPT,
-                             cwd=str(product_request.generator_path.parent),
-                             stdout=subprocess.PIPE,  #self.stdout,
-                             stderr=subprocess.STDOUT, # Use same stream as stdout, be it os.stdout or subprocess.STDOUT
-                             shell=True,
-                             env=params)
-              
-        self.run_process(p, product_request, product_request.log)              
-        if (p.returncode != 0):
-            if (product_request.stdout):
-                log_file = Path(str(product_request.path)+'.stdout.log')
-                product_request.log.warn('Writing STDOUT log: {0}'.format(log_file))            
-                log_file.write_text(product_request.stdout)
-            if (product_request.stderr):
-                log_file = Path(str(product_request.path)+'.stderr.log')
-                product_request.log.warn('Writing STDERR log: {0}'.format(log_file))            
-                log_file.write_text(product_request.stderr)
+        # stderr: use same stream as stdout, be it os.stdout or subprocess.STDOUT
+        self.run_script(product_request.generator_path, subprocess.STDOUT, params,
+                        product_request, product_request.log)
+        if (product_request.returncode != 0):
+            self.write_generator_logs(product_request)
             
-        return p.returncode
+        return product_request.returncode
+
+    def write_generator_logs(self, product_request):
+        """Save outputs of a failed generator next to the product file."""
+        base = product_request._path_str
+        if (product_request.stdout):
+            log_file = base + '.stdout.log'
+            product_request.log.warn('Writing STDOUT log: {0}'.format(log_file))            
+            Path(log_file).write_bytes(product_request.stdout)
+        if (product_request.stderr):
+            log_file = base + '.stderr.log'
+            product_request.log.warn('Writing STDERR log: {0}'.format(log_file))            
+            Path(log_file).write_bytes(product_request.stderr)
+
+    def run_batch_generator(self, requests):
+        """Run the generators of several products in a single shell process, in parallel.
+
+        Attributes:
+          requests -- list of (product_request, params) pairs, generators being bash scripts.
+        """
+        if (not self._gen_sem.acquire(timeout=float(self.PROCESS_QUEUE_TIMEOUT))):
+            self.logger.error('No free process slot for batch of {0}'.format(len(requests)))
+            for pr,params in requests:
+                pr.returncode = -1
+                pr.status = HTTPStatus.SERVICE_UNAVAILABLE
+            return
+        # Each script running in parallel holds a slot: take the free ones, up to MAX_INPUT_WORKERS
+        slots = 1
+        while (slots < min(int(self.MAX_INPUT_WORKERS), len(requests))) and self._gen_sem.acquire(blocking=False):
+            slots += 1
+        try:
+            for pr,params in requests:
+                pr.log.info('run_generator (batch): ' + pr.product_info.ID)
+                pr.log.debug(params)
+            results = nutpool.run_batch([(pr.generator_path, params) for pr,params in requests], slots)
+        finally:
+            for i in range(slots):
+                self._gen_sem.release()
+
+        for (pr,params),(returncode,stdout) in zip(requests, results):
+            self.set_process_result(pr, returncode, stdout, None, pr.log)
+            if (returncode != 0):
+                self.write_generator_logs(pr)
 
 
     def make_request(self, product_info, actions = ['MAKE'], directives = None, log = None):
@@ -516,9 +702,88 @@ class ProductServer:
         'MAKE'   - return the product, if in cache, else generate it and return
         'DELETE' - delete the product in cache
         'INPUTS' - generate and store the product, also regenerate even if already exists
+        'MAKE_BATCH' - with MAKE, generate missing inputs in a single process
         """
         product_request = self.ProductRequest(self, product_info, actions, directives, log)
         return self.handle_request(product_request)
+
+    def make_batch_requests(self, product_infos, log):
+        """Make several products, running the generators of missing ones in a single process.
+
+        Products having an input script, or a generator other than a bash script,
+        are made separately with handle_missing(), concurrently with the batch.
+
+        Attributes:
+          product_infos -- dict of ProductInfo objects
+        Returns a dict of ProductRequests, with the keys of product_infos.
+        """
+        results = {}
+        batch = []
+        separate = []
+        for key,info in product_infos.items():
+            pr = self.ProductRequest(self, info, ['MAKE', 'MAKE_BATCH'], [], log.getChild("input[{0}]".format(key)))
+            results[key] = pr
+            if (self.resolve_existing(pr)):
+                continue
+            input_script = os.path.join(self.get_generator_dir(pr.product_info), self.SHELL_INPUT_SCRIPT)
+            if (path_exists(input_script) or not nutpool.is_bash_script(str(pr.generator_path))):
+                separate.append(pr)
+            else:
+                batch.append((pr, self.prepare_generation(pr)))
+
+        with self.input_executor(len(separate)) as executor:
+            futures = [executor.submit(self.handle_missing, pr) for pr in separate]
+            if (batch):
+                log.info('Generating {0} inputs in a batch'.format(len(batch)))
+                self.run_batch_generator(batch)
+                for pr,params in batch:
+                    self.finish_generation(pr)
+        for f in futures:
+            f.result() # raise possible exceptions
+        return results
+
+    def input_executor(self, count):
+        """Thread pool for making count input products concurrently, bounded by MAX_INPUT_WORKERS."""
+        return ThreadPoolExecutor(max_workers=max(1, min(int(self.MAX_INPUT_WORKERS), count)))
+
+    def prepare_generation(self, pr):
+        """Create output directories and an empty placeholder file. Returns environment for the generator."""
+        # Path components derived once
+        path = pr.path
+        tmp_dir = pr.path_tmp.parent
+        pr.log.debug('Ensuring cache dir for: {0}'.format(path))
+        # The tmp dir is verified, as cache cleanup may remove it (or the whole product dir)
+        self.ensure_output_dir(tmp_dir, True)
+        self.ensure_output_dir(path.parent)
+
+        # what about true ENV?
+        params = dict(pr._env)
+        params['OUTDIR']  = str(tmp_dir)
+        params['OUTFILE'] = path.name
+        # Completed in handle_request, if the product has inputs
+        params['INPUTKEYS'] = ''
+        #os.mknod(pr.path) # = touch
+        touch(pr._path_str)
+        return params
+
+    def finish_generation(self, pr):
+        """Check the result of a generator and move the product from tmp. Returns True on success."""
+        if (pr.returncode != 0):
+            pr.log.error("generator failed")
+            if (pr.status == HTTPStatus.SERVICE_UNAVAILABLE):
+                # Not started, allow retrying later
+                os.unlink(pr._path_str)
+                pr.path = ''
+            return False
+            
+        if (pr.path_tmp.stat().st_size == 0):
+            pr.log.error("generator failed")
+            return False
+        
+        pr.log.debug("Final move from tmp")
+        os.replace(pr._path_tmp_str, pr._path_str)
+        pr.set_status(HTTPStatus.OK)
+        return True
         
         
     def handle_request(self, pr):
@@ -527,15 +792,30 @@ class ProductServer:
         'DELETE' - delete the product in cache
         'INPUTS' - generate and store the product, also regenerate even if already exists
         """
-        
-        if (pr.path.exists()):  
+        if (self.resolve_existing(pr)):
+            return pr
+        return self.handle_missing(pr)
+
+    def resolve_existing(self, pr):
+        """Complete the request, if possible, without running scripts.
+
+        Serves or deletes a product found in cache (or reports it BUSY), and rejects
+        products without a generator. Returns True if the request was completed.
+        """
+        # Single stat for both existence and size
+        try:
+            st = os.stat(pr._path_str)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+
+        if (st != None):  
             pr.log.debug('File exists: {0}'.format(pr.path))
             if ('DELETE' in pr.actions):
                 pr.log.info('Deleting...')
-                pr.path.unlink()
+                os.unlink(pr._path_str)
                 pr.set_status(HTTPStatus.ACCEPTED)  #202 # Accepted
             elif ('MAKE' in pr.actions): # PATH_ONLY
-                if (pr.path.stat().st_size > 0):
+                if (st.st_size > 0):
                     pr.product = pr.path
                     pr.log.info('Non-empty result file found: ' + str(pr.path))
                     pr.set_status(HTTPStatus.OK)
@@ -543,57 +823,82 @@ class ProductServer:
                     pr.product = '' # BUSY
                     pr.log.warning('BUSY') # TODO riase (prevent deletion)
                     pr.set_status(HTTPStatus.ACCEPTED)  #202 # Accepted
-                return pr
+                return True
         else:
             pr.log.debug('File not found: {0}'.format(pr.path))
 
+        # Generator recently found missing: skip checking and logging again
+        missed = self._no_generator.get(pr.product_info.ID)
+        if (missed != None) and (time.monotonic() - missed < float(self.NO_GENERATOR_TTL)):
+            pr.log.debug('Generator script not found (cached): {0}'.format(pr.generator_path))
+            pr.path = ''
+            pr.set_status(HTTPStatus.NOT_IMPLEMENTED)
+            return True
+
         # only check at this point
         #if (os.path.exists(pr.generator_script)):
-        if (pr.generator_path.exists()):
+        if (path_exists(pr.generator_path)):
             pr.log.debug('Generator script ok: {0}'.format(pr.generator_path))
         else:
             pr.log.warning('Generator script not found: {0}'.format(pr.generator_path))
+            self._no_generator[pr.product_info.ID] = time.monotonic()
             # Consider case of copied valid product (without local generator)            
             pr.path = ''
             pr.set_status(HTTPStatus.NOT_IMPLEMENTED) # Not Implemented
-            return pr
-        
+            return True
+        return False
+
+    def handle_missing(self, pr):
+        """Run input listing and generation for a request not completed by resolve_existing()."""
 
         # TODO: if not stream?
         params = {}
         if ('MAKE' in pr.actions):
-            pr.log.debug('Ensuring cache dir for: {0}'.format(pr.path))
-            self.ensure_output_dir(pr.path_tmp.parent)
-            self.ensure_output_dir(pr.path.parent)
-
-            # what about true ENV?
-            params = pr.product_info.get_param_env() # {})
-            params['OUTDIR']  = str(pr.path_tmp.parent)
-            params['OUTFILE'] = pr.path.name
-            #os.mknod(pr.path) # = touch
-            pr.path.touch()
+            params = self.prepare_generation(pr)
             
         # Runs input.sh
         if ('MAKE' in pr.actions) or ('INPUTS' in pr.actions):
-            input_info = self.get_input_list(pr.product_info, pr.directives, pr.log.getChild('get_input_list'))
+            input_info = self.get_input_list(pr.product_info, pr.directives, pr.log.getChild('get_input_list'), pr._env)
             if (input_info.returncode == 0):
                 pr.inputs = input_info.inputs
+            elif (input_info.status == HTTPStatus.SERVICE_UNAVAILABLE):
+                pr.set_status(HTTPStatus.SERVICE_UNAVAILABLE)
+                # Placeholder file exists only for MAKE
+                if ('MAKE' in pr.actions):
+                    pr.log.info('Removing: {0} '.format(pr.path))
+                    os.unlink(pr._path_str)
+                pr.path = ''
+                return pr
             else:
                 #         pr.log.warn('Not HTTP error code: {0} '.format(status))
                 pr.set_status(HTTPStatus.CONFLICT)
-                pr.log.info('Removing: {0} '.format(pr.path))
-                pr.path.unlink()
+                if ('MAKE' in pr.actions):
+                    pr.log.info('Removing: {0} '.format(pr.path))
+                    os.unlink(pr._path_str)
                 return pr
 
         if ('MAKE' in pr.actions): 
-            pr.log.debug('Retrieving inputs for: ' + str(pr.path.name))
+            pr.log.debug('Retrieving inputs for: ' + os.path.basename(pr._path_str))
             inputs = {}
+            input_infos = {}
             for i in pr.inputs:
                 #pr.log.info('INPUTFILE: ' + i)
                 input = pr.inputs[i] # <filename>.h5
-                input_prod_info = nutproduct.ProductInfo(input)
-                pr.log.info('Make input: {0} ({1})'.format(i, input_prod_info.ID))
-                r = self.make_request(input_prod_info, ['MAKE'], [], pr.log.getChild("input[{0}]".format(i)))
+                input_infos[i] = _parse_product_info(input)
+                pr.log.info('Make input: {0} ({1})'.format(i, input_infos[i].ID))
+
+            if ('MAKE_BATCH' in pr.actions):
+                results = self.make_batch_requests(input_infos, pr.log)
+            else:
+                # Inputs are independent: generate them concurrently, as the workers mostly wait for subprocesses
+                futures = {}
+                with self.input_executor(len(input_infos)) as executor:
+                    for i,input_prod_info in input_infos.items():
+                        futures[i] = executor.submit(self.make_request, input_prod_info, ['MAKE'], [],
+                                                     pr.log.getChild("input[{0}]".format(i)))
+                results = {i: f.result() for i,f in futures.items()}
+
+            for i,r in results.items():
                 if (r.path):
                     inputs[i] = str(r.path) # sensitive
                     pr.log.debug('Success: ' + str(r.path))
@@ -610,36 +915,27 @@ class ProductServer:
             pr.log.info('Generating: {0}'.format(pr.path))
             self.run_generator(pr, params)
 
-            if (pr.returncode != 0):
-                pr.log.error("generator failed")
+            if (not self.finish_generation(pr)):
                 return pr
                 
-            if (pr.path_tmp.stat().st_size == 0):
-                pr.log.error("generator failed")
-                return pr
-            
-            pr.log.debug("Final move from tmp")
-            pr.path_tmp.replace(pr.path)
-            pr.set_status(HTTPStatus.OK)
-                
             try:
                 if ('LINK' in pr.directives): #and pr.product_info.TIMESTAMP:
                     pr.log.info('LINK: {0} '.format(pr.path_static))
-                    self.ensure_output_dir(pr.path_static.parent)
+                    self.ensure_output_dir(pr.path_static.parent, True)
                     nutils.symlink(pr.path_static, pr.path)
          
                 if ('LATEST' in pr.directives):
                     pr.log.info('LATEST: {0} '.format(pr.path_latest))
-                    self.ensure_output_dir(pr.path_latest.parent)
+                    self.ensure_output_dir(pr.path_latest.parent, True)
                     nutils.symlink(pr.path_latest, pr.path, True)
             except:
                  pr.log.warn("Linking file failed")               
  
             if ('DEBUG' in pr.directives) or ('LOG' in pr.directives):
-                logfile = Path(str(pr.path) + '.log')
+                logfile = Path(pr._path_str + '.log')
                 pr.log.info('Saving log: {0} '.format(logfile))
                 try:
-                    logfile.write_text(pr.stdout) #.decode(encoding='UTF-8'))            
+                    logfile.write_bytes(pr.stdout)
                 except:
                     pr.log.warn("Saving log failed")               
                 
@@ -706,7 +1002,7 @@ if __name__ == '__main__':
         request.append('INPUTS')
 
     if (options.REQUEST):
-        request.append(options.REQUEST.split(','))
+        request.extend(options.REQUEST.split(','))
         
     if (options.DELETE):
         request.append('DELETE')